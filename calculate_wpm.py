@@ -6,7 +6,7 @@ Uses Google Gemini API for transcription. Processes all MP3 files in the
 wpm-measure folder and calculates average WPM if multiple files exist.
 
 Requirements:
-    pip install google-genai pydub python-dotenv
+    pip install google-genai mutagen tenacity python-dotenv
 
 Environment:
     GEMINI_API_KEY - Your Google Gemini API key (can be set in .env file)
@@ -15,8 +15,13 @@ Environment:
 import os
 import sys
 import json
+import shutil
+import asyncio
+import hashlib
+import argparse
 from pathlib import Path
 from datetime import datetime
+from collections import Counter
 
 try:
     from dotenv import load_dotenv
@@ -26,45 +31,248 @@ except ImportError:
 
 try:
     from google import genai
-    from google.genai import types
+    from google.genai import errors, types
+    from pydantic import BaseModel
 except ImportError:
     print("Error: google-genai package not installed.")
     print("Install with: pip install google-genai")
     sys.exit(1)
 
 try:
-    from pydub import AudioSegment
+    from tenacity import (
+        retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+    )
+except ImportError:
+    print("Error: tenacity package not installed.")
+    print("Install with: pip install tenacity")
+    sys.exit(1)
+
+try:
+    from mutagen.mp3 import MP3
 except ImportError:
-    print("Error: pydub package not installed.")
-    print("Install with: pip install pydub")
+    print("Error: mutagen package not installed.")
+    print("Install with: pip install mutagen")
     sys.exit(1)
 
 
+# Maximum number of concurrent Gemini requests (Gemini rate limits)
+MAX_CONCURRENT_REQUESTS = 8
+
+# Maximum number of files transcribed in a single Gemini request, keeping
+# the combined JSON response well within the model's output token limit
+MAX_FILES_PER_BATCH = 10
+
+# Times a batch is re-requested for clips missing from the model's response
+MAX_BATCH_ATTEMPTS = 3
+
+# Model used for transcription
+TRANSCRIPTION_MODEL = "gemini-2.5-flash-lite"
+
+# Gemini's cap on the total size of a request carrying inline data
+INLINE_REQUEST_LIMIT_BYTES = 20_000_000
+
+# Space reserved for the prompt, clip labels and JSON request envelope
+INLINE_REQUEST_MARGIN_BYTES = 1_000_000
+
+# Total size of audio sent inline (per request) instead of via the Files API.
+# Inline data is base64-encoded (4 bytes per 3), so the raw audio budget is
+# 3/4 of what remains under the request cap (~14 MB).
+INLINE_AUDIO_LIMIT_BYTES = (
+    (INLINE_REQUEST_LIMIT_BYTES - INLINE_REQUEST_MARGIN_BYTES) * 3 // 4
+)
+
+# Transcriptions are cached here, keyed by a hash of the audio file contents
+CACHE_DIR = Path.home() / ".cache" / "voice-training" / "wpm"
+
+# Bump when the transcription prompt changes so older cache entries are ignored
+CACHE_VERSION = 3
+
+
+def is_transient_error(exc: BaseException) -> bool:
+    """Check whether a Gemini error is worth retrying (5xx or rate limit)."""
+    if isinstance(exc, errors.ServerError):
+        return True
+    return isinstance(exc, errors.ClientError) and exc.code == 429
+
+
+# Retry policy for Gemini requests, so one flaky call doesn't abort the run
+gemini_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception(is_transient_error),
+    reraise=True
+)
+
+
+class Transcript(BaseModel):
+    """Structured transcription result for one clip in a batch request."""
+    clip_id: str
+    transcript: str
+
+
 def get_audio_duration_seconds(file_path: Path) -> float:
-    """Get the duration of an audio file in seconds using pydub."""
-    audio = AudioSegment.from_file(file_path)
-    return len(audio) / 1000.0  # pydub returns milliseconds
-
-
-def transcribe_audio(client: genai.Client, file_path: Path) -> str:
-    """Transcribe audio file using Gemini API."""
-    print(f"  Uploading {file_path.name}...")
-    uploaded_file = client.files.upload(file=file_path)
-
-    print(f"  Transcribing...")
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=[
-            types.Part.from_uri(
-                file_uri=uploaded_file.uri,
-                mime_type="audio/mpeg"
-            ),
-            "Transcribe this audio exactly as spoken. "
-            "Return ONLY the transcription text, nothing else."
-        ]
+    """Get the duration of an audio file in seconds from its MP3 headers."""
+    return MP3(file_path).info.length
+
+
+def file_content_hash(file_path: Path) -> str:
+    """Hash an audio file's contents to use as a cache key."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_cached_result(key: str) -> dict | None:
+    """Load a cached transcription result, if a usable one exists.
+
+    Entries made with a different model or cache version, or missing
+    fields, are treated as a miss.
+    """
+    cache_file = CACHE_DIR / f"{key}.json"
+    if not cache_file.exists():
+        return None
+    try:
+        with open(cache_file) as f:
+            entry = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None  # Treat unreadable cache entries as a miss
+
+    if not isinstance(entry, dict):
+        return None
+    if entry.get("model") != TRANSCRIPTION_MODEL:
+        return None
+    if entry.get("cache_version") != CACHE_VERSION:
+        return None
+    if "transcript" not in entry or "duration" not in entry:
+        return None
+    return entry
+
+
+def save_cached_result(key: str, result: dict) -> None:
+    """Save a transcription result to the cache."""
+    entry = {"model": TRANSCRIPTION_MODEL, "cache_version": CACHE_VERSION, **result}
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_DIR / f"{key}.json", "w") as f:
+        json.dump(entry, f)
+
+
+@gemini_retry
+async def upload_file(client: genai.Client, file_path: Path) -> types.File:
+    """Upload a file through the Gemini Files API.
+
+    Pass the path rather than the file contents: the SDK streams it with the
+    resumable upload protocol in 8 MB chunks, so each in-flight upload holds
+    one chunk in memory rather than the whole file.
+    """
+    return await client.aio.files.upload(file=file_path)
+
+
+@gemini_retry
+async def request_transcripts(
+    client: genai.Client,
+    contents: list
+) -> list[Transcript]:
+    """Request structured transcripts for a batch of audio clips."""
+    response = await client.aio.models.generate_content(
+        model=TRANSCRIPTION_MODEL,
+        contents=contents,
+        config=types.GenerateContentConfig(
+            response_mime_type="application/json",
+            response_schema=list[Transcript]
+        )
+    )
+    return response.parsed or []
+
+
+async def prepare_audio_part(
+    client: genai.Client,
+    file_path: Path,
+    inline: bool,
+    semaphore: asyncio.Semaphore
+) -> types.Part:
+    """Build the request part for an audio file, uploading it if needed."""
+    if inline:
+        # Part.from_bytes needs real bytes (the SDK base64-encodes them), so
+        # read the file once in a single allocation, off the event loop
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, file_path.read_bytes)
+        return types.Part.from_bytes(data=data, mime_type="audio/mpeg")
+
+    async with semaphore:
+        print(f"  Uploading {file_path.name}...")
+        uploaded_file = await upload_file(client, file_path)
+    return types.Part.from_uri(
+        file_uri=uploaded_file.uri,
+        mime_type="audio/mpeg"
     )
 
-    return response.text.strip()
+
+async def transcribe_batch(
+    client: genai.Client,
+    file_paths: list[Path],
+    semaphore: asyncio.Semaphore
+) -> dict[Path, str]:
+    """Transcribe several audio files with a single Gemini request.
+
+    Files are sent inline while they fit within the inline request budget;
+    the rest are uploaded through the Files API first. Clips the model leaves
+    out of its response, or returns more than once, are requested again, up
+    to MAX_BATCH_ATTEMPTS times.
+    Returns transcripts keyed by file; files still missing are omitted.
+    """
+    inline_budget = INLINE_AUDIO_LIMIT_BYTES
+    inline_flags = []
+    for file_path in file_paths:
+        size = file_path.stat().st_size
+        inline_flags.append(size <= inline_budget)
+        if size <= inline_budget:
+            inline_budget -= size
+
+    parts = await asyncio.gather(*[
+        prepare_audio_part(client, file_path, inline, semaphore)
+        for file_path, inline in zip(file_paths, inline_flags)
+    ])
+
+    transcripts = {}
+    remaining = list(zip(file_paths, parts))
+    for attempt in range(1, MAX_BATCH_ATTEMPTS + 1):
+        # Clips are labelled with their file names, which the model echoes
+        # back as clip_id, so responses never depend on how it numbers clips
+        contents = []
+        for file_path, part in remaining:
+            contents.extend([f"Audio clip {file_path.name}:", part])
+        contents.append(
+            "Transcribe each audio clip exactly as spoken. "
+            "Return a JSON array with one {clip_id, transcript} object per clip, "
+            "where clip_id is the clip's label above, copied exactly."
+        )
+
+        async with semaphore:
+            names = ", ".join(f.name for f, _ in remaining)
+            print(f"  Transcribing {names}...")
+            parsed = await request_transcripts(client, contents)
+
+        # A clip_id returned more than once is ambiguous; re-request that clip
+        id_counts = Counter(t.clip_id for t in parsed)
+        returned = {
+            t.clip_id: t.transcript.strip()
+            for t in parsed if id_counts[t.clip_id] == 1
+        }
+
+        for file_path, _ in remaining:
+            if file_path.name in returned:
+                transcripts[file_path] = returned[file_path.name]
+
+        remaining = [(f, part) for f, part in remaining if f not in transcripts]
+        if not remaining:
+            break
+        if attempt < MAX_BATCH_ATTEMPTS:
+            names = ", ".join(f.name for f, _ in remaining)
+            print(f"  No usable transcript returned for {names}, retrying...")
+
+    return transcripts
 
 
 def count_words(text: str) -> int:
@@ -80,7 +288,139 @@ def calculate_wpm(word_count: int, duration_seconds: float) -> float:
     return word_count / duration_minutes
 
 
-def main():
+def save_analysis(output_file: Path, output: dict) -> None:
+    """Save analysis results as JSON.
+
+    The summary is pretty-printed for reading; each per-file entry (which
+    carries the full transcript) is written as a single compact line.
+    """
+    header = {key: value for key, value in output.items() if key != "files"}
+    header_json = json.dumps(header, indent=2)[:-2]  # Drop the closing "\n}"
+    files_json = ",\n    ".join(
+        json.dumps(entry, separators=(",", ":")) for entry in output["files"]
+    )
+    with open(output_file, "w") as f:
+        f.write(f'{header_json},\n  "files": [\n    {files_json}\n  ]\n}}\n')
+
+
+async def analyze_files(
+    client: genai.Client,
+    mp3_files: list[Path],
+    use_cache: bool = True
+) -> list[dict]:
+    """Measure, transcribe and calculate WPM for each audio file.
+
+    Cached transcriptions are reused; the remaining files are transcribed in
+    batches of up to MAX_FILES_PER_BATCH, with batches running concurrently.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+
+    # Hash files for the cache lookup (blocking file I/O, so off the event loop)
+    keys = await asyncio.gather(*[
+        loop.run_in_executor(None, file_content_hash, f) for f in mp3_files
+    ])
+
+    transcripts = {}
+    durations = {}
+    if use_cache:
+        for mp3_file, key in zip(mp3_files, keys):
+            cached = load_cached_result(key)
+            if cached:
+                print(f"Using cached transcription for {mp3_file.name}")
+                transcripts[mp3_file] = cached["transcript"]
+                durations[mp3_file] = cached["duration"]
+
+    # Transcribe everything not found in the cache, reading durations in
+    # worker threads while uploads and transcription requests are in flight.
+    # Each batch is cached as soon as it finishes, so a failing batch does
+    # not throw away the others.
+    pending = [f for f in mp3_files if f not in transcripts]
+    batches = [
+        pending[i:i + MAX_FILES_PER_BATCH]
+        for i in range(0, len(pending), MAX_FILES_PER_BATCH)
+    ]
+    cache_keys = dict(zip(mp3_files, keys))
+
+    async def transcribe_and_cache(batch: list[Path]) -> None:
+        batch_durations, batch_transcripts = await asyncio.gather(
+            asyncio.gather(*[
+                loop.run_in_executor(None, get_audio_duration_seconds, f)
+                for f in batch
+            ]),
+            transcribe_batch(client, batch, semaphore)
+        )
+        for mp3_file, duration in zip(batch, batch_durations):
+            durations[mp3_file] = duration
+            if mp3_file not in batch_transcripts:
+                continue
+            transcript = batch_transcripts[mp3_file]
+            transcripts[mp3_file] = transcript
+            save_cached_result(cache_keys[mp3_file], {
+                "transcript": transcript,
+                "duration": duration,
+                "wpm": calculate_wpm(count_words(transcript), duration)
+            })
+
+    outcomes = await asyncio.gather(
+        *[transcribe_and_cache(batch) for batch in batches],
+        return_exceptions=True
+    )
+    failures = [o for o in outcomes if isinstance(o, BaseException)]
+    if failures:
+        raise failures[0]
+
+    missing = [f.name for f in mp3_files if f not in transcripts]
+    if missing:
+        raise ValueError(f"No transcript returned for: {', '.join(missing)}")
+
+    results = []
+    for mp3_file in mp3_files:
+        duration = durations[mp3_file]
+        transcript = transcripts[mp3_file]
+        word_count = count_words(transcript)
+
+        # Calculate WPM
+        wpm = calculate_wpm(word_count, duration)
+
+        print(f"\nProcessed: {mp3_file.name}")
+        print(f"  Duration: {duration:.1f} seconds ({duration/60:.2f} minutes)")
+        print(f"  Word count: {word_count}")
+        print(f"  WPM: {wpm:.1f}")
+
+        results.append({
+            "file": mp3_file.name,
+            "duration_seconds": round(duration, 2),
+            "word_count": word_count,
+            "wpm": round(wpm, 1),
+            "transcript": transcript
+        })
+
+    print()
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Calculate words per minute from audio samples"
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Ignore cached transcriptions and re-transcribe every file"
+    )
+    parser.add_argument(
+        "--clear-cache",
+        action="store_true",
+        help="Delete all cached transcriptions before running"
+    )
+
+    args = parser.parse_args()
+
+    if args.clear_cache and CACHE_DIR.exists():
+        shutil.rmtree(CACHE_DIR)
+        print(f"Cleared transcription cache: {CACHE_DIR}\n")
+
     # Setup paths
     script_dir = Path(__file__).parent
     wpm_measure_dir = script_dir / "wpm-measure"
@@ -102,43 +442,26 @@ def main():
         print(f"Error: Directory not found: {wpm_measure_dir}")
         sys.exit(1)
 
-    mp3_files = list(wpm_measure_dir.glob("*.mp3"))
+    mp3_files = sorted(
+        Path(entry.path) for entry in os.scandir(wpm_measure_dir)
+        if entry.is_file() and entry.name.lower().endswith(".mp3")
+    )
     if not mp3_files:
         print(f"Error: No MP3 files found in {wpm_measure_dir}")
         sys.exit(1)
 
     print(f"Found {len(mp3_files)} MP3 file(s) to analyze.\n")
 
-    # Process each file
-    results = []
-    for mp3_file in mp3_files:
-        print(f"Processing: {mp3_file.name}")
-
-        # Get duration
-        duration = get_audio_duration_seconds(mp3_file)
-        print(f"  Duration: {duration:.1f} seconds ({duration/60:.2f} minutes)")
-
-        # Transcribe
-        transcript = transcribe_audio(client, mp3_file)
-        word_count = count_words(transcript)
-        print(f"  Word count: {word_count}")
-
-        # Calculate WPM
-        wpm = calculate_wpm(word_count, duration)
-        print(f"  WPM: {wpm:.1f}\n")
+    # Process all files
+    results = await analyze_files(client, mp3_files, use_cache=not args.no_cache)
 
-        results.append({
-            "file": mp3_file.name,
-            "duration_seconds": round(duration, 2),
-            "word_count": word_count,
-            "wpm": round(wpm, 1),
-            "transcript": transcript
-        })
-
-    # Calculate average WPM
-    average_wpm = sum(r["wpm"] for r in results) / len(results)
-    total_words = sum(r["word_count"] for r in results)
-    total_duration = sum(r["duration_seconds"] for r in results)
+    # Calculate totals and average WPM in a single pass
+    total_wpm = total_words = total_duration = 0
+    for r in results:
+        total_wpm += r["wpm"]
+        total_words += r["word_count"]
+        total_duration += r["duration_seconds"]
+    average_wpm = total_wpm / len(results)
 
     # Prepare output
     output = {
@@ -154,8 +477,7 @@ def main():
 
     # Create user-context directory and save results
     user_context_dir.mkdir(exist_ok=True)
-    with open(output_file, "w") as f:
-        json.dump(output, f, indent=2)
+    save_analysis(output_file, output)
 
     # Print summary
     print("=" * 50)
@@ -169,4 +491,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -6,7 +6,7 @@ Uses Google Gemini API to generate text for narration based on target duration
 and reading style. Supports single file or chunked output.
 
 Requirements:
-    pip install google-genai python-dotenv
+    pip install google-genai tenacity python-dotenv
 
 Environment:
     GEMINI_API_KEY - Your Google Gemini API key (can be set in .env file)
@@ -15,9 +15,14 @@ Environment:
 import os
 import sys
 import json
+import shutil
+import asyncio
+import tempfile
 import argparse
+from io import StringIO
 from pathlib import Path
 from datetime import datetime
+from types import MappingProxyType
 
 try:
     from dotenv import load_dotenv
@@ -27,11 +32,64 @@ except ImportError:
 
 try:
     from google import genai
+    from google.genai import errors
 except ImportError:
     print("Error: google-genai package not installed.")
     print("Install with: pip install google-genai")
     sys.exit(1)
 
+try:
+    from tenacity import (
+        retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
+    )
+except ImportError:
+    print("Error: tenacity package not installed.")
+    print("Install with: pip install tenacity")
+    sys.exit(1)
+
+
+# Buffer size for output files, so each file is flushed in as few writes as possible
+WRITE_BUFFER_SIZE = 1 << 20
+
+# Prompt modifiers for each supported text style
+STYLE_PROMPTS = MappingProxyType({
+    "conversational": (
+        "Write in a natural, conversational tone as if speaking to a friend. "
+        "Include occasional filler words, natural pauses, and casual language. "
+        "Topics can range widely - anecdotes, observations, musings."
+    ),
+    "narrative": (
+        "Write engaging narrative prose suitable for an audiobook. "
+        "Include descriptive passages, varied sentence structures, "
+        "and compelling storytelling. Can be fiction or creative non-fiction."
+    ),
+    "technical": (
+        "Write clear technical explanations or tutorials. "
+        "Include precise terminology but maintain readability for narration. "
+        "Topics can include technology, science, programming, or engineering."
+    ),
+    "news_anchor": (
+        "Write in a professional news broadcast style. "
+        "Clear, authoritative tone with good pacing for broadcast delivery. "
+        "Include varied news topics - current events, features, human interest."
+    ),
+    "storytelling": (
+        "Write immersive short stories or story excerpts. "
+        "Include dialogue, scene descriptions, and emotional moments. "
+        "Vary between action, reflection, and character development."
+    ),
+    "educational": (
+        "Write informative educational content suitable for a documentary. "
+        "Include interesting facts, clear explanations, and engaging delivery. "
+        "Topics can span history, nature, culture, science."
+    ),
+    "podcast": (
+        "Write in an engaging podcast monologue style. "
+        "Include rhetorical questions, audience engagement phrases, "
+        "and natural transitions between topics."
+    )
+})
+
 
 def load_config(config_path: Path) -> dict:
     """Load configuration from config.json."""
@@ -47,57 +105,44 @@ def calculate_word_count(duration_minutes: float, wpm: int) -> int:
     return int(duration_minutes * wpm)
 
 
+def is_transient_error(exc: BaseException) -> bool:
+    """Check whether a Gemini error is worth retrying (5xx or rate limit)."""
+    if isinstance(exc, errors.ServerError):
+        return True
+    return isinstance(exc, errors.ClientError) and exc.code == 429
+
+
+# Retry policy for Gemini requests, so one flaky call doesn't abort the run
+gemini_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception(is_transient_error),
+    reraise=True
+)
+
+
 def get_style_prompt(style: str) -> str:
     """Get the prompt modifier for a given style."""
-    style_prompts = {
-        "conversational": (
-            "Write in a natural, conversational tone as if speaking to a friend. "
-            "Include occasional filler words, natural pauses, and casual language. "
-            "Topics can range widely - anecdotes, observations, musings."
-        ),
-        "narrative": (
-            "Write engaging narrative prose suitable for an audiobook. "
-            "Include descriptive passages, varied sentence structures, "
-            "and compelling storytelling. Can be fiction or creative non-fiction."
-        ),
-        "technical": (
-            "Write clear technical explanations or tutorials. "
-            "Include precise terminology but maintain readability for narration. "
-            "Topics can include technology, science, programming, or engineering."
-        ),
-        "news_anchor": (
-            "Write in a professional news broadcast style. "
-            "Clear, authoritative tone with good pacing for broadcast delivery. "
-            "Include varied news topics - current events, features, human interest."
-        ),
-        "storytelling": (
-            "Write immersive short stories or story excerpts. "
-            "Include dialogue, scene descriptions, and emotional moments. "
-            "Vary between action, reflection, and character development."
-        ),
-        "educational": (
-            "Write informative educational content suitable for a documentary. "
-            "Include interesting facts, clear explanations, and engaging delivery. "
-            "Topics can span history, nature, culture, science."
-        ),
-        "podcast": (
-            "Write in an engaging podcast monologue style. "
-            "Include rhetorical questions, audience engagement phrases, "
-            "and natural transitions between topics."
-        )
-    }
-    return style_prompts.get(style, style_prompts["conversational"])
+    return STYLE_PROMPTS.get(style, STYLE_PROMPTS["conversational"])
 
 
-def generate_text_chunk(
+@gemini_retry
+async def generate_text_chunk(
     client: genai.Client,
+    semaphore: asyncio.Semaphore,
     word_count: int,
     style: str,
     chunk_number: int = 1,
     total_chunks: int = 1,
-    topic_hint: str = ""
-) -> str:
-    """Generate a single chunk of text using Gemini."""
+    topic_hint: str = "",
+    output_path: Path | None = None
+) -> dict:
+    """Generate a single chunk of text using Gemini.
+
+    The response is streamed; if output_path is given, text is written to it
+    as it arrives. Returns the text with its target and actual word counts.
+    Transient API errors restart the chunk from scratch, up to 5 attempts.
+    """
 
     style_prompt = get_style_prompt(style)
 
@@ -135,39 +180,86 @@ Requirements:
 
 Generate the text now:"""
 
-    response = client.models.generate_content(
-        model="gemini-2.0-flash",
-        contents=prompt
-    )
+    buffer = StringIO()
+    out = open(output_path, "w", buffering=WRITE_BUFFER_SIZE) if output_path else None
+    try:
+        async with semaphore:
+            print(f"Generating chunk {chunk_number}/{total_chunks} (~{word_count} words)...")
+            stream = await client.aio.models.generate_content_stream(
+                model="gemini-2.0-flash",
+                contents=prompt
+            )
+            # Hold back trailing whitespace until more text follows, so the
+            # file ends up with exactly the stripped text
+            held_whitespace = ""
+            async for part in stream:
+                if not part.text:
+                    continue
+                piece = part.text
+                if buffer.tell() == 0:
+                    piece = piece.lstrip()
+                content = piece.rstrip()
+                if not content:
+                    held_whitespace += piece
+                    continue
+                piece = held_whitespace + content
+                held_whitespace = part.text[len(part.text.rstrip()):]
+                buffer.write(piece)
+                if out:
+                    out.write(piece)
+    finally:
+        if out:
+            out.close()
+
+    text = buffer.getvalue()
+    actual_words = len(text.split())
+    print(f"  Chunk {chunk_number}: generated {actual_words} words")
+    return {
+        "text": text,
+        "target_words": word_count,
+        "actual_words": actual_words
+    }
+
 
-    return response.text.strip()
+def create_session_dir(output_dir: Path) -> Path:
+    """Create a hidden staging directory for generated output.
+
+    Files are written to output_dir/.session_*/ and moved into place by
+    save_output, so a session only appears once it is complete.
+    """
+    output_dir.mkdir(parents=True, exist_ok=True)
+    staging_dir = Path(tempfile.mkdtemp(dir=output_dir, prefix=".session_"))
+
+    # mkdtemp creates the directory private (0700); use normal permissions
+    umask = os.umask(0)
+    os.umask(umask)
+    staging_dir.chmod(0o777 & ~umask)
+    return staging_dir
+
+
+def chunk_filename(chunk_number: int, total_chunks: int) -> str:
+    """Get the output filename for a chunk."""
+    if total_chunks == 1:
+        return "script.txt"
+    return f"chunk_{chunk_number:02d}.txt"
 
 
 def save_output(
-    output_dir: Path,
+    staging_dir: Path,
     texts: list[dict],
     style: str,
     total_duration: float,
     wpm: int
 ) -> Path:
-    """Save generated texts to output directory."""
+    """Save generation metadata and publish the session directory.
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    session_dir = output_dir / f"session_{timestamp}"
-    session_dir.mkdir(parents=True, exist_ok=True)
-
-    # Save individual text files
-    for i, text_data in enumerate(texts, 1):
-        if len(texts) == 1:
-            filename = "script.txt"
-        else:
-            filename = f"chunk_{i:02d}.txt"
-
-        filepath = session_dir / filename
-        with open(filepath, "w") as f:
-            f.write(text_data["text"])
+    Chunk text files are written while streaming in generate_text_chunk.
+    Everything is synced to disk, then the staging directory is renamed
+    into the output directory in one step.
+    """
 
     # Save metadata
+    total_words = sum(t["actual_words"] for t in texts)
     metadata = {
         "generated_at": datetime.now().isoformat(),
         "style": style,
@@ -175,29 +267,43 @@ def save_output(
         "wpm_used": wpm,
         "chunks": [
             {
-                "file": f"chunk_{i:02d}.txt" if len(texts) > 1 else "script.txt",
+                "file": chunk_filename(i, len(texts)),
                 "target_word_count": t["target_words"],
-                "actual_word_count": len(t["text"].split()),
-                "estimated_duration_minutes": round(len(t["text"].split()) / wpm, 2)
+                "actual_word_count": t["actual_words"],
+                "estimated_duration_minutes": round(t["actual_words"] / wpm, 2)
             }
             for i, t in enumerate(texts, 1)
         ],
         "totals": {
-            "total_words": sum(len(t["text"].split()) for t in texts),
-            "estimated_total_duration_minutes": round(
-                sum(len(t["text"].split()) for t in texts) / wpm, 2
-            )
+            "total_words": total_words,
+            "estimated_total_duration_minutes": round(total_words / wpm, 2)
         }
     }
 
-    metadata_path = session_dir / "metadata.json"
-    with open(metadata_path, "w") as f:
+    metadata_path = staging_dir / "metadata.json"
+    with open(metadata_path, "w", buffering=WRITE_BUFFER_SIZE) as f:
         json.dump(metadata, f, indent=2)
 
+    # Flush file data to disk once, just before the session becomes visible
+    sync = getattr(os, "fdatasync", os.fsync)  # fdatasync is unavailable on macOS
+    for path in staging_dir.iterdir():
+        with open(path, "rb") as f:
+            sync(f.fileno())
+
+    # Session names have one-second resolution, so add a suffix rather than
+    # colliding with a session published in the same second
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    session_dir = staging_dir.parent / f"session_{timestamp}"
+    suffix = 2
+    while session_dir.exists():
+        session_dir = staging_dir.parent / f"session_{timestamp}_{suffix}"
+        suffix += 1
+    os.replace(staging_dir, session_dir)
+
     return session_dir
 
 
-def main():
+async def main():
     parser = argparse.ArgumentParser(
         description="Generate reading scripts for voice cloning"
     )
@@ -211,7 +317,8 @@ def main():
         "-s", "--style",
         type=str,
         default=None,
-        help="Text style (conversational, narrative, technical, news_anchor, storytelling, educational, podcast)"
+        choices=list(STYLE_PROMPTS),
+        help="Text style (default: default_style from config)"
     )
     parser.add_argument(
         "-c", "--chunks",
@@ -249,8 +356,8 @@ def main():
 
     # Determine style
     style = args.style or config.get("default_style", "conversational")
-    if style not in config.get("available_styles", [style]):
-        print(f"Warning: Style '{style}' not in available styles. Using anyway.")
+    if style not in STYLE_PROMPTS:
+        parser.error(f"Unknown style: {style}. Choices: {', '.join(STYLE_PROMPTS)}")
 
     # Calculate chunks
     if args.chunk_duration:
@@ -286,33 +393,43 @@ def main():
     print("=" * 60)
     print()
 
-    # Generate chunks
-    generated_texts = []
-    for i in range(1, num_chunks + 1):
-        target_words = calculate_word_count(chunk_duration, wpm)
-        print(f"Generating chunk {i}/{num_chunks} (~{target_words} words)...")
+    # Chunk files are streamed into a staging directory
+    output_dir = script_dir / config.get("output_directory", "output")
+    staging_dir = create_session_dir(output_dir)
 
-        text = generate_text_chunk(
+    # Generate chunks concurrently (gather preserves chunk order)
+    target_words = calculate_word_count(chunk_duration, wpm)
+    semaphore = asyncio.Semaphore(config.get("max_parallel", 5))
+    tasks = [
+        asyncio.create_task(generate_text_chunk(
             client=client,
+            semaphore=semaphore,
             word_count=target_words,
             style=style,
             chunk_number=i,
             total_chunks=num_chunks,
-            topic_hint=args.topic
-        )
-
-        actual_words = len(text.split())
-        print(f"  Generated {actual_words} words")
-
-        generated_texts.append({
-            "text": text,
-            "target_words": target_words,
-            "actual_words": actual_words
-        })
-
-    # Save output
-    output_dir = script_dir / config.get("output_directory", "output")
-    session_dir = save_output(output_dir, generated_texts, style, args.duration, wpm)
+            topic_hint=args.topic,
+            output_path=staging_dir / chunk_filename(i, num_chunks)
+        ))
+        for i in range(1, num_chunks + 1)
+    ]
+    try:
+        generated_texts = await asyncio.gather(*tasks)
+    except BaseException:
+        # Stop the remaining chunks and discard the partial session
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        raise
+
+    # Save metadata and publish the session. Generation already succeeded, so
+    # if this fails keep the staged files rather than losing them.
+    try:
+        session_dir = save_output(staging_dir, generated_texts, style, args.duration, wpm)
+    except BaseException:
+        print(f"Error: Could not publish session. Generated files kept in: {staging_dir}")
+        raise
 
     # Summary
     total_actual = sum(t["actual_words"] for t in generated_texts)
@@ -330,4 +447,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())